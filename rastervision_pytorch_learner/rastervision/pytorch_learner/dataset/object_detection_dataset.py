@@ -1,6 +1,6 @@
 from typing import TYPE_CHECKING, Optional, Tuple, List, Dict, Union
 from os.path import join
-from collections import defaultdict
+from itertools import chain
 import logging
 
 import albumentations as A
@@ -40,25 +40,51 @@ class CocoDataset(Dataset):
             img['id']: join(img_dir, img['file_name'])
             for img in ann_json['images']
         }
-        self.img_anns = {id: defaultdict(list) for id in self.img_ids}
-        for ann in ann_json['annotations']:
-            img_ann = self.img_anns[ann['image_id']]
-            img_ann['bboxes'].append(ann['bbox'])
-            img_ann['category_id'].append(ann['category_id'])
+        self.img_anns = {
+            id: {
+                'bboxes': np.empty((0, 4), dtype=np.float32),
+                'category_id': np.empty((0, ), dtype=np.int64)
+            }
+            for id in self.img_ids
+        }
+
+        # Extract all annotations into flat arrays, sort them by image ID, and
+        # split them into one group per image.
+        anns = ann_json['annotations']
+        num_anns = len(anns)
+        ann_img_ids = np.fromiter((ann['image_id'] for ann in anns),
+                                  dtype=np.int64,
+                                  count=num_anns)
+        bboxes = np.fromiter(
+            chain.from_iterable(ann['bbox'] for ann in anns),
+            dtype=np.float32,
+            count=num_anns * 4).reshape(-1, 4)
+        class_ids = np.fromiter((ann['category_id'] for ann in anns),
+                                dtype=np.int64,
+                                count=num_anns)
+
+        sort_inds = np.argsort(ann_img_ids, kind='stable')
+        ann_img_ids = ann_img_ids[sort_inds]
+        bboxes = bboxes[sort_inds]
+        class_ids = class_ids[sort_inds]
+        uniq_img_ids, split_inds = np.unique(ann_img_ids, return_index=True)
+        bboxes_per_img = np.split(bboxes, split_inds[1:])
+        class_ids_per_img = np.split(class_ids, split_inds[1:])
+        for img_id, img_bboxes, img_class_ids in zip(
+                uniq_img_ids.tolist(), bboxes_per_img, class_ids_per_img):
+            img_ann = self.img_anns[img_id]
+            img_ann['bboxes'] = img_bboxes
+            img_ann['category_id'] = img_class_ids
 
     def __getitem__(self, ind: int
                     ) -> Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray, str]]:
         img_id = self.img_ids[ind]
         path = self.img_paths[img_id]
-        ann: Dict[str, list] = self.img_anns[img_id]
+        ann: Dict[str, np.ndarray] = self.img_anns[img_id]
 
         x = load_image(path)
-        bboxes = np.array(ann['bboxes'])
-        class_ids = np.array(ann['category_id'], dtype=np.int64)
-
-        if len(bboxes) == 0:
-            bboxes = np.empty((0, 4))
-            class_ids = np.empty((0, ), dtype=np.int64)
+        bboxes = ann['bboxes']
+        class_ids = ann['category_id']
         return x, (bboxes, class_ids, 'xywh')
 
     def __len__(self):
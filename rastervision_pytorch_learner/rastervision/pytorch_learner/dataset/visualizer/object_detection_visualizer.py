@@ -21,6 +21,8 @@ class ObjectDetectionVisualizer(Visualizer):
                  y: BoxList,
                  z: Optional[BoxList] = None) -> None:
         y = y if z is None else z
+        # make sure y is on the CPU before drawing boxes
+        y = y.to('cpu')
         channel_groups = self.get_channel_display_groups(x.shape[1])
 
         class_names = self.class_names
@@ -1165,10 +1165,17 @@ class Learner(ABC):
         Returns:
             x but with any Tensors in it on the device
         """
+        # Batches from the DataLoaders are in pinned memory, so copies to the
+        # GPU can be asynchronous. Copies back to the CPU must stay blocking
+        # since their results are used right away.
+        non_blocking = torch.device(device).type == 'cuda'
         if isinstance(x, list):
-            return [_x.to(device) if _x is not None else _x for _x in x]
+            return [
+                _x.to(device, non_blocking=non_blocking)
+                if _x is not None else _x for _x in x
+            ]
         else:
-            return x.to(device)
+            return x.to(device, non_blocking=non_blocking)
 
     def train_epoch(
             self,
@@ -1,49 +1,75 @@
 from typing import (Any, Callable, Optional, Sequence, Tuple, Iterable, List,
                     Dict, Union)
-from collections import defaultdict
-from os.path import join
-from operator import iand
-from functools import reduce
 
 import torch
 import torch.nn as nn
 from torchvision.ops import (box_area, box_convert, batched_nms,
                              clip_boxes_to_image)
 from torchvision.utils import draw_bounding_boxes
+import numpy as np
+
 import pycocotools
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
-import numpy as np
 
-from rastervision.pipeline.file_system import json_to_file, get_tmp_dir
+# faster-coco-eval is an optional drop-in replacement for pycocotools that
+# implements evaluate() and accumulate() in C++.
+try:
+    from faster_coco_eval import COCO as FasterCOCO, COCOeval_faster
+    FASTER_COCO_EVAL_AVAILABLE = True
+except ImportError:
+    FASTER_COCO_EVAL_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Above this many boxes, torchvision's NMS op is used even on the CPU since
+# its per-call overhead is no longer significant. Below it, BoxList.nms uses a
+# Numba-compiled kernel if numba is installed. The kernel is compiled on its
+# first use, which takes a few seconds, and the result is cached on disk for
+# later processes.
+NUMBA_NMS_MAX_BOXES = 2048
+
+
+def _get_coco_img_ids(boxlists: Sequence['BoxList']) -> List[int]:
+    """Return the 1-indexed image ID of each box in the given BoxLists."""
+    counts = torch.tensor([len(bl) for bl in boxlists], dtype=torch.long)
+    img_ids = torch.arange(1, len(boxlists) + 1)
+    return torch.repeat_interleave(img_ids, counts).tolist()
 
 
 def get_coco_gt(targets: Iterable['BoxList'],
                 num_class_ids: int) -> Dict[str, List[dict]]:
-    images = []
+    targets = list(targets)
+    # Use fake height, width, and filename because they don't matter.
+    images = [{
+        'id': img_id,
+        'height': 1000,
+        'width': 1000,
+        'file_name': '{}.png'.format(img_id)
+    } for img_id in range(1, len(targets) + 1)]
+
     annotations = []
-    ann_id = 1
-    for img_id, target in enumerate(targets, 1):
-        # Use fake height, width, and filename because they don't matter.
-        images.append({
-            'id': img_id,
-            'height': 1000,
-            'width': 1000,
-            'file_name': '{}.png'.format(img_id)
-        })
-        boxes = target.convert_boxes('xywh').float().tolist()
-        class_ids = target.get_field('class_ids').tolist()
-        areas = box_area(target.boxes).tolist()
-        for box, class_id, area in zip(boxes, class_ids, areas):
-            annotations.append({
-                'id': ann_id,
-                'image_id': img_id,
-                'bbox': box,
-                'category_id': class_id + 1,
-                'area': area,
-                'iscrowd': 0
-            })
-            ann_id += 1
+    if len(targets) > 0:
+        # convert all boxes in one go and move them to the CPU only once
+        boxes = torch.cat([t.boxes for t in targets]).float()
+        class_ids = torch.cat([t.get_field('class_ids') for t in targets])
+        boxes_xywh = _xyxy_to_xywh(boxes).cpu().tolist()
+        areas = box_area(boxes).cpu().tolist()
+        class_ids = class_ids.cpu().tolist()
+        img_ids = _get_coco_img_ids(targets)
+        annotations = [{
+            'id': ann_id,
+            'image_id': img_id,
+            'bbox': box,
+            'category_id': class_id + 1,
+            'area': area,
+            'iscrowd': 0
+        } for ann_id, (img_id, box, class_id, area) in enumerate(
+            zip(img_ids, boxes_xywh, class_ids, areas), 1)]
 
     categories = [{
         'id': class_id + 1,
@@ -59,23 +85,33 @@ def get_coco_gt(targets: Iterable['BoxList'],
 
 
 def get_coco_preds(outputs: Iterable['BoxList']) -> List[dict]:
-    preds = []
-    for img_id, output in enumerate(outputs, 1):
-        boxes = output.convert_boxes('xywh').float().tolist()
-        class_ids = output.get_field('class_ids').tolist()
-        scores = output.get_field('scores').tolist()
-        for box, class_id, score in zip(boxes, class_ids, scores):
-            preds.append({
-                'image_id': img_id,
-                'category_id': class_id + 1,
-                'bbox': box,
-                'score': score
-            })
+    outputs = list(outputs)
+    if len(outputs) == 0:
+        return []
+
+    # convert all boxes in one go and move them to the CPU only once
+    boxes = torch.cat([o.boxes for o in outputs]).float()
+    class_ids = torch.cat([o.get_field('class_ids') for o in outputs])
+    scores = torch.cat([o.get_field('scores') for o in outputs])
+    boxes_xywh = _xyxy_to_xywh(boxes).cpu().tolist()
+    class_ids = class_ids.cpu().tolist()
+    scores = scores.cpu().tolist()
+    img_ids = _get_coco_img_ids(outputs)
+    preds = [{
+        'image_id': img_id,
+        'category_id': class_id + 1,
+        'bbox': box,
+        'score': score
+    } for img_id, box, class_id, score in zip(img_ids, boxes_xywh, class_ids,
+                                               scores)]
     return preds
 
 
 def compute_coco_eval(outputs, targets, num_class_ids):
-    """Return mAP averaged over 0.5-0.95 using pycocotools eval.
+    """Return mAP averaged over 0.5-0.95 using COCO eval.
+
+    Uses faster-coco-eval if it is installed and falls back to pycocotools
+    otherwise.
 
     Note: boxes are in (ymin, xmin, ymax, xmax) format with values ranging
         from 0 to h or w.
@@ -89,27 +125,131 @@ def compute_coco_eval(outputs, targets, num_class_ids):
             {'boxes': <tensor with shape (n, 4)>,
              'class_ids': <tensor with shape (n,)>}
     """
-    with get_tmp_dir() as tmp_dir:
-        preds = get_coco_preds(outputs)
-        # ap is undefined when there are no predicted boxes
-        if len(preds) == 0:
-            return None
-
-        gt = get_coco_gt(targets, num_class_ids)
-        gt_path = join(tmp_dir, 'gt.json')
-        json_to_file(gt, gt_path)
-        coco_gt = COCO(gt_path)
-
+    preds = get_coco_preds(outputs)
+    # ap is undefined when there are no predicted boxes
+    if len(preds) == 0:
+        return None
+
+    gt = get_coco_gt(targets, num_class_ids)
+    # build the index directly from the in-memory dict instead of writing it
+    # to a JSON file and reading it back
+    coco_gt = FasterCOCO() if FASTER_COCO_EVAL_AVAILABLE else COCO()
+    coco_gt.dataset = gt
+    coco_gt.createIndex()
+
+    if FASTER_COCO_EVAL_AVAILABLE:
+        coco_preds = coco_gt.loadRes(preds)
+        coco_eval = COCOeval_faster(
+            coco_gt,
+            coco_preds,
+            iouType='bbox',
+            print_function=lambda *args, **kwargs: None)
+    else:
         pycocotools.coco.unicode = None
         coco_preds = coco_gt.loadRes(preds)
-
         coco_eval = COCOeval(cocoGt=coco_gt, cocoDt=coco_preds, iouType='bbox')
 
-        coco_eval.evaluate()
-        coco_eval.accumulate()
-        coco_eval.summarize()
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+
+    return coco_eval
+
+
+def _nms_kernel(boxes: np.ndarray, scores: np.ndarray,
+                iou_thresh: float) -> np.ndarray:
+    """Greedy NMS over (n, 4) xyxy boxes. Returns the indices of the kept
+    boxes sorted by decreasing score. Mirrors torchvision's CPU kernel.
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-scores, kind='mergesort')
+    n = len(order)
+    suppressed = np.zeros(n, dtype=np.bool_)
+    keep = np.empty(n, dtype=np.int64)
+    num_keep = 0
+    for _i in range(n):
+        i = order[_i]
+        if suppressed[i]:
+            continue
+        keep[num_keep] = i
+        num_keep += 1
+        for _j in range(_i + 1, n):
+            j = order[_j]
+            if suppressed[j]:
+                continue
+            w = max(0., min(x2[i], x2[j]) - max(x1[i], x1[j]))
+            h = max(0., min(y2[i], y2[j]) - max(y1[i], y1[j]))
+            inter = w * h
+            union = areas[i] + areas[j] - inter
+            # Two zero-area boxes have an undefined IoU. Like torchvision
+            # (which gets NaN), do not suppress in that case.
+            if union > 0 and inter / union > iou_thresh:
+                suppressed[j] = True
+    return keep[:num_keep]
+
+
+if NUMBA_AVAILABLE:
+    _nms_kernel = njit(cache=True, error_model='numpy')(_nms_kernel)
+
+
+def _batched_nms_numba(boxes: torch.Tensor, scores: torch.Tensor,
+                       class_ids: torch.Tensor,
+                       iou_thresh: float) -> torch.Tensor:
+    """Class-aware NMS on the CPU using the Numba-compiled kernel.
+
+    Like torchvision's batched_nms, boxes of different classes are offset
+    so that they never overlap, which lets a single NMS pass handle all
+    classes.
+    """
+    offsets = class_ids.to(boxes) * (boxes.max() + 1)
+    boxes = boxes + offsets[:, None]
+    keep = _nms_kernel(boxes.detach().numpy(),
+                       scores.detach().numpy(), iou_thresh)
+    return torch.as_tensor(keep)
+
+
+def _swap_xy(boxes: torch.Tensor) -> torch.Tensor:
+    """Convert (n, 4) boxes between the xyxy and yxyx formats."""
+    return torch.stack(
+        (boxes[:, 1], boxes[:, 0], boxes[:, 3], boxes[:, 2]), dim=1)
+
 
-        return coco_eval
+def _xywh_to_xyxy(boxes: torch.Tensor) -> torch.Tensor:
+    x, y, w, h = boxes.unbind(1)
+    return torch.stack((x, y, x + w, y + h), dim=1)
+
+
+def _xyxy_to_xywh(boxes: torch.Tensor) -> torch.Tensor:
+    x1, y1, x2, y2 = boxes.unbind(1)
+    return torch.stack((x1, y1, x2 - x1, y2 - y1), dim=1)
+
+
+def _cxcywh_to_xyxy(boxes: torch.Tensor) -> torch.Tensor:
+    cx, cy, w, h = boxes.unbind(1)
+    half_w, half_h = 0.5 * w, 0.5 * h
+    return torch.stack((cx - half_w, cy - half_h, cx + half_w, cy + half_h),
+                       dim=1)
+
+
+def _xyxy_to_cxcywh(boxes: torch.Tensor) -> torch.Tensor:
+    x1, y1, x2, y2 = boxes.unbind(1)
+    return torch.stack(((x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1),
+                       dim=1)
+
+
+# Closed-form conversions for the common formats, to avoid the overhead of
+# torchvision's box_convert. Other formats fall back to box_convert.
+_TO_XYXY: Dict[str, Callable[[torch.Tensor], torch.Tensor]] = {
+    'yxyx': _swap_xy,
+    'xywh': _xywh_to_xyxy,
+    'cxcywh': _cxcywh_to_xyxy,
+}
+_FROM_XYXY: Dict[str, Callable[[torch.Tensor], torch.Tensor]] = {
+    'yxyx': _swap_xy,
+    'xywh': _xyxy_to_xywh,
+    'cxcywh': _xyxy_to_cxcywh,
+}
 
 
 class BoxList():
@@ -128,8 +268,8 @@ class BoxList():
         self.extras = extras
         if format == 'xyxy':
             self.boxes = boxes
-        elif format == 'yxyx':
-            self.boxes = boxes[:, [1, 0, 3, 2]]
+        elif format in _TO_XYXY:
+            self.boxes = _TO_XYXY[format](boxes)
         else:
             self.boxes = box_convert(boxes, format, 'xyxy')
 
@@ -167,8 +307,8 @@ class BoxList():
         return BoxList(boxes, **extras)
 
     def convert_boxes(self, out_fmt: str) -> torch.Tensor:
-        if out_fmt == 'yxyx':
-            boxes = self.boxes[:, [1, 0, 3, 2]]
+        if out_fmt in _FROM_XYXY:
+            boxes = _FROM_XYXY[out_fmt](self.boxes)
         else:
             boxes = box_convert(self.boxes, 'xyxy', out_fmt)
         return boxes
@@ -178,32 +318,36 @@ class BoxList():
 
     @staticmethod
     def cat(box_lists: Iterable['BoxList']) -> 'BoxList':
-        boxes = []
-        extras = defaultdict(list)
-        for bl in box_lists:
-            boxes.append(bl.boxes)
-            for k, v in bl.extras.items():
-                extras[k].append(v)
+        box_lists = list(box_lists)
+        if len(box_lists) == 0:
+            raise ValueError('box_lists must not be empty')
+        keys = list(box_lists[0].extras.keys())
+        for bl in box_lists[1:]:
+            if bl.extras.keys() != box_lists[0].extras.keys():
+                raise ValueError(
+                    'All BoxLists must have the same extras. '
+                    f'Found {sorted(bl.extras.keys())} and {sorted(keys)}.')
+        boxes = [bl.boxes for bl in box_lists]
+        extras = {k: [bl.extras[k] for bl in box_lists] for k in keys}
         boxes = torch.cat(boxes)
-        for k, v in extras.items():
-            extras[k] = torch.cat(v)
+        extras = {k: torch.cat(v) for k, v in extras.items()}
         return BoxList(boxes, **extras)
 
+    def _to_unique_rows(self) -> torch.Tensor:
+        """Return boxes and extras as a tensor of sorted, unique rows."""
+        extras = [(v.float().unsqueeze(1) if v.ndim == 1 else v.float())
+                  for v in self.extras.values()]
+        cat_arr = torch.cat([self.boxes.float()] + extras, 1)
+        return torch.unique(cat_arr, sorted=True, dim=0)
+
     def equal(self, other: 'BoxList') -> bool:
         if len(other) != len(self):
             return False
 
         # Ignore order of boxes.
-        extras = [(v.float().unsqueeze(1) if v.ndim == 1 else v.float())
-                  for v in self.extras.values()]
-        cat_arr = torch.cat([self.boxes] + extras, 1)
-        self_tups = set([tuple([x.item() for x in row]) for row in cat_arr])
-
-        extras = [(v.float().unsqueeze(1) if v.ndim == 1 else v.float())
-                  for v in other.extras.values()]
-        cat_arr = torch.cat([other.boxes] + extras, 1)
-        other_tups = set([tuple([x.item() for x in row]) for row in cat_arr])
-        return self_tups == other_tups
+        self_rows = self._to_unique_rows()
+        other_rows = other._to_unique_rows().to(self_rows.device)
+        return torch.equal(self_rows, other_rows)
 
     def ind_filter(self, inds: Sequence[int]) -> 'BoxList':
         boxes = self.boxes[inds]
@@ -219,20 +363,47 @@ class BoxList():
             raise ValueError('must have scores as key in extras')
 
     def clip_boxes(self, img_height: int, img_width: int) -> 'BoxList':
-        boxes = clip_boxes_to_image(self.boxes, (img_height, img_width))
+        boxes = self.boxes
+        # On the CPU, checking the bounds is cheaper than clamping every
+        # column. On the GPU, the check would force a device sync, so always
+        # clamp instead.
+        if boxes.device.type == 'cpu' and len(boxes) > 0:
+            inside = (boxes.min() >= 0 and boxes[:, 0::2].max() <= img_width
+                      and boxes[:, 1::2].max() <= img_height)
+            if inside:
+                return BoxList(boxes, **self.extras)
+        boxes = clip_boxes_to_image(boxes, (img_height, img_width))
         return BoxList(boxes, **self.extras)
 
     def nms(self, iou_thresh: float = 0.5) -> torch.Tensor:
+        """Class-aware non-maximum suppression.
+
+        If numba is installed, BoxLists on the CPU with at most
+        NUMBA_NMS_MAX_BOXES boxes use a Numba-compiled kernel. The first such
+        call compiles the kernel. Otherwise, torchvision's batched_nms is used.
+        """
         if len(self) == 0:
             return self
 
-        good_inds = batched_nms(self.boxes, self.get_field('scores'),
-                                self.get_field('class_ids'), iou_thresh)
+        boxes = self.boxes
+        scores = self.get_field('scores')
+        class_ids = self.get_field('class_ids')
+        use_numba = (NUMBA_AVAILABLE and boxes.device.type == 'cpu'
+                     and len(self) <= NUMBA_NMS_MAX_BOXES)
+        if use_numba:
+            good_inds = _batched_nms_numba(boxes, scores, class_ids,
+                                           iou_thresh)
+        else:
+            good_inds = batched_nms(boxes, scores, class_ids, iou_thresh)
         return self.ind_filter(good_inds)
 
     def scale(self, yscale: float, xscale: float) -> 'BoxList':
-        boxes = self.boxes * torch.tensor(
-            [[yscale, xscale, yscale, xscale]], device=self.boxes.device)
+        if self.boxes.is_floating_point():
+            boxes = self.boxes.clone()
+        else:
+            boxes = self.boxes.float()
+        boxes[:, 0::2] *= yscale
+        boxes[:, 1::2] *= xscale
         return BoxList(boxes, **self.extras)
 
     def pin_memory(self) -> 'BoxList':
@@ -244,9 +415,9 @@ class BoxList():
 
 
 def collate_fn(data: Iterable[Sequence]) -> Tuple[torch.Tensor, List[BoxList]]:
-    imgs = [d[0] for d in data]
-    x = torch.stack(imgs)
-    y: List[BoxList] = [d[1] for d in data]
+    imgs, boxlists = zip(*data)
+    x = torch.stack(imgs, dim=0)
+    y: List[BoxList] = list(boxlists)
     return x, y
 
 
@@ -255,15 +426,16 @@ def draw_boxes(x: torch.Tensor, y: BoxList, class_names: Sequence[str],
     """Given an image and a BoxList, draw the boxes in the BoxList on the
     image."""
     boxes = y.boxes
-    class_ids: np.ndarray = y.get_field('class_ids').numpy()
+    class_ids: np.ndarray = y.get_field('class_ids').cpu().numpy()
     scores: Optional[torch.Tensor] = y.get_field('scores')
 
     if len(boxes) > 0:
         box_annotations: List[str] = np.array(class_names)[class_ids].tolist()
         if scores is not None:
+            # convert to a list once instead of formatting 0-d tensors
             box_annotations = [
                 f'{ann} | {score:.2f}'
-                for ann, score in zip(box_annotations, scores)
+                for ann, score in zip(box_annotations, scores.tolist())
             ]
         box_colors: List[Union[str, Tuple[int, ...]]] = [
             tuple(c) if not isinstance(c, str) else c
@@ -309,6 +481,18 @@ class TorchVisionODAdapter(nn.Module):
         super().__init__()
         self.model = model
         self.ignored_output_inds = ignored_output_inds
+        ignored_output_inds = list(ignored_output_inds)
+        # non-persistent so that it moves with the module across devices
+        # without being added to the state dict
+        self.register_buffer(
+            'ignored_output_inds_tensor',
+            torch.as_tensor(ignored_output_inds, dtype=torch.long),
+            persistent=False)
+        # with a single ignored index (the common case), a plain comparison
+        # suffices
+        self._ignored_single: Optional[int] = None
+        if len(ignored_output_inds) == 1:
+            self._ignored_single = ignored_output_inds[0]
 
     def forward(self,
                 input: torch.Tensor,
@@ -376,8 +560,10 @@ class TorchVisionODAdapter(nn.Module):
             BoxList: A BoxList with "class_ids" and "scores" fields.
         """
         # keep only the detections of the non-null classes
-        exclude_masks = [out['labels'] != i for i in self.ignored_output_inds]
-        mask = reduce(iand, exclude_masks)
+        if self._ignored_single is not None:
+            mask = out['labels'] != self._ignored_single
+        else:
+            mask = ~torch.isin(out['labels'], self.ignored_output_inds_tensor)
         boxlist = BoxList(
             boxes=out['boxes'][mask],
             # make class IDs 0-indexed again
@@ -0,0 +1,119 @@
+from os.path import join
+import pickle
+import unittest
+
+import numpy as np
+
+from rastervision.pipeline.file_system import json_to_file, get_tmp_dir
+from rastervision.pytorch_learner.dataset import CocoDataset
+
+
+class TestCocoDataset(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = get_tmp_dir()
+        self.img_dir = self.tmp_dir.name
+        self.imgs = {}
+        for img_id in [1, 2]:
+            img = np.full((4, 4, 3), img_id, dtype=np.uint8)
+            np.save(join(self.img_dir, f'{img_id}.npy'), img)
+            self.imgs[img_id] = img
+        images = [{
+            'id': img_id,
+            'file_name': f'{img_id}.npy'
+        } for img_id in [1, 2]]
+        annotations = [{
+            'image_id': 1,
+            'bbox': [0, 0, 1, 1],
+            'category_id': 1
+        }]
+        self.annotation_uri = join(self.tmp_dir.name, 'annotations.json')
+        json_to_file({
+            'images': images,
+            'annotations': annotations
+        }, self.annotation_uri)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_pickle(self):
+        ds = CocoDataset(self.img_dir, self.annotation_uri)
+        ds_unpickled = pickle.loads(pickle.dumps(ds))
+        x, (bboxes, class_ids, box_format) = ds_unpickled[0]
+        np.testing.assert_array_equal(x, self.imgs[1])
+        np.testing.assert_array_equal(bboxes, [[0, 0, 1, 1]])
+        np.testing.assert_array_equal(class_ids, [1])
+        self.assertEqual(box_format, 'xywh')
+
+
+class TestCocoDatasetAnnotations(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = get_tmp_dir()
+        self.annotation_uri = join(self.tmp_dir.name, 'annotations.json')
+        self.images = [{
+            'id': img_id,
+            'file_name': f'{img_id}.png'
+        } for img_id in [3, 1, 2]]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_annotations(self):
+        # image IDs are unsorted and interleaved, and image 2 has no boxes
+        annotations = [
+            {
+                'image_id': 3,
+                'bbox': [0, 0, 1, 1],
+                'category_id': 1
+            },
+            {
+                'image_id': 1,
+                'bbox': [1, 1, 2, 2],
+                'category_id': 2
+            },
+            {
+                'image_id': 3,
+                'bbox': [2, 2, 3, 3],
+                'category_id': 3
+            },
+            {
+                'image_id': 1,
+                'bbox': [3, 3, 4, 4],
+                'category_id': 4
+            },
+        ]
+        json_to_file({
+            'images': self.images,
+            'annotations': annotations
+        }, self.annotation_uri)
+        ds = CocoDataset(self.tmp_dir.name, self.annotation_uri)
+        self.assertEqual(len(ds), 3)
+
+        # per-image box order matches the order in the file
+        ann = ds.img_anns[3]
+        np.testing.assert_array_equal(ann['bboxes'],
+                                      [[0, 0, 1, 1], [2, 2, 3, 3]])
+        np.testing.assert_array_equal(ann['category_id'], [1, 3])
+        ann = ds.img_anns[1]
+        np.testing.assert_array_equal(ann['bboxes'],
+                                      [[1, 1, 2, 2], [3, 3, 4, 4]])
+        np.testing.assert_array_equal(ann['category_id'], [2, 4])
+        ann = ds.img_anns[2]
+        self.assertEqual(ann['bboxes'].shape, (0, 4))
+        self.assertEqual(ann['category_id'].shape, (0, ))
+
+    def test_no_annotations(self):
+        json_to_file({
+            'images': self.images,
+            'annotations': []
+        }, self.annotation_uri)
+        ds = CocoDataset(self.tmp_dir.name, self.annotation_uri)
+        self.assertEqual(len(ds), 3)
+        for ann in ds.img_anns.values():
+            self.assertEqual(ann['bboxes'].shape, (0, 4))
+            self.assertEqual(ann['bboxes'].dtype, np.float32)
+            self.assertEqual(ann['category_id'].shape, (0, ))
+            self.assertEqual(ann['category_id'].dtype, np.int64)
+
+
+if __name__ == '__main__':
+    unittest.main()
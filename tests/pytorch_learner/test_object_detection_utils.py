@@ -1,12 +1,16 @@
+from typing import List
 import unittest
+from unittest.mock import patch
 
 import numpy as np
 import torch
 from torch import nn
-from torchvision.ops import box_convert
+from torchvision.ops import box_convert, batched_nms
 
+from rastervision.pytorch_learner import object_detection_utils
 from rastervision.pytorch_learner.object_detection_utils import (
-    BoxList, collate_fn, TorchVisionODAdapter)
+    BoxList, collate_fn, TorchVisionODAdapter, compute_coco_eval,
+    _batched_nms_numba, FASTER_COCO_EVAL_AVAILABLE)
 
 
 class MockModel(nn.Module):
@@ -86,6 +90,58 @@ class TestTorchVisionODAdapter(unittest.TestCase):
                     for c in out.get_field('class_ids')))
 
 
+class TestComputeCocoEval(unittest.TestCase):
+    def setUp(self) -> None:
+        # image 1: 1 box, predicted exactly; image 2: 2 boxes, only 1 of them
+        # predicted exactly
+        self.targets = [
+            BoxList(
+                torch.tensor([[10., 10., 50., 50.]]),
+                class_ids=torch.tensor([0])),
+            BoxList(
+                torch.tensor([[100., 100., 200., 200.],
+                              [300., 300., 400., 400.]]),
+                class_ids=torch.tensor([1, 1])),
+        ]
+        self.outputs = [
+            BoxList(
+                torch.tensor([[10., 10., 50., 50.]]),
+                class_ids=torch.tensor([0]),
+                scores=torch.tensor([0.9])),
+            BoxList(
+                torch.tensor([[100., 100., 200., 200.]]),
+                class_ids=torch.tensor([1]),
+                scores=torch.tensor([0.8])),
+        ]
+
+    def _test_compute_coco_eval(self):
+        coco_eval = compute_coco_eval(self.outputs, self.targets, 2)
+        # class 0: AP = 1; class 1: precision 1 up to recall 0.5, so AP is
+        # 51/101 with COCO's 101-point interpolation
+        expected_ap = (1 + 51 / 101) / 2
+        self.assertAlmostEqual(coco_eval.stats[0], expected_ap)
+        self.assertAlmostEqual(coco_eval.stats[1], expected_ap)
+
+        # no predictions
+        outputs = [
+            BoxList(
+                torch.empty((0, 4)),
+                class_ids=torch.empty((0, )).long(),
+                scores=torch.empty((0, ))) for _ in self.targets
+        ]
+        self.assertIsNone(compute_coco_eval(outputs, self.targets, 2))
+
+    def test_compute_coco_eval_pycocotools(self):
+        with patch.object(object_detection_utils,
+                          'FASTER_COCO_EVAL_AVAILABLE', False):
+            self._test_compute_coco_eval()
+
+    @unittest.skipIf(not FASTER_COCO_EVAL_AVAILABLE,
+                     'faster-coco-eval is not installed')
+    def test_compute_coco_eval_faster_coco_eval(self):
+        self._test_compute_coco_eval()
+
+
 class TestBoxList(unittest.TestCase):
     def test_init(self):
         boxes = torch.rand((10, 4))
@@ -103,6 +159,35 @@ class TestBoxList(unittest.TestCase):
             self.assertTrue(
                 torch.equal(boxlist.boxes, box_convert(boxes, in_fmt, 'xyxy')))
 
+    def test_convert_boxes(self):
+        boxes = torch.rand((10, 4))
+        boxlist = BoxList(boxes)
+        for out_fmt in ['yxyx', 'xywh', 'cxcywh']:
+            if out_fmt == 'yxyx':
+                expected = boxes[:, [1, 0, 3, 2]]
+            else:
+                expected = box_convert(boxes, 'xyxy', out_fmt)
+            self.assertTrue(
+                torch.equal(boxlist.convert_boxes(out_fmt), expected))
+
+    def test_scale(self):
+        yscale, xscale = 0.5, 2.
+        scale = torch.tensor([[yscale, xscale, yscale, xscale]])
+        float_boxes = torch.rand((10, 4)) * 100
+        int_boxes = torch.randint(0, 100, (10, 4))
+        for boxes in [float_boxes, int_boxes]:
+            orig_boxes = boxes.clone()
+            boxlist = BoxList(boxes, class_ids=torch.randint(0, 3, (10, )))
+            scaled = boxlist.scale(yscale, xscale)
+            self.assertTrue(torch.equal(scaled.boxes, boxes * scale))
+            self.assertTrue(scaled.boxes.is_floating_point())
+            self.assertTrue(
+                torch.equal(
+                    scaled.get_field('class_ids'),
+                    boxlist.get_field('class_ids')))
+            # the input boxes are not modified
+            self.assertTrue(torch.equal(boxes, orig_boxes))
+
     def test_get_field(self):
         boxes = torch.rand((10, 4))
         class_ids = torch.randint(0, 5, (10, ))
@@ -140,6 +225,94 @@ class TestBoxList(unittest.TestCase):
             torch.equal(boxlist.get_field('scores'), scores.float()))
         self.assertTrue(all(class_names == boxlist.get_field('class_names')))
 
+    def test_clip_boxes(self):
+        boxes = torch.tensor([[10., 20., 30., 40.], [-5., 5., 60., 110.]])
+        boxlist = BoxList(boxes)
+        clipped = boxlist.clip_boxes(img_height=100, img_width=50)
+        expected = torch.tensor([[10., 20., 30., 40.], [0., 5., 50., 100.]])
+        self.assertTrue(torch.equal(clipped.boxes, expected))
+        # boxes already inside the image are left as they are
+        clipped = clipped.clip_boxes(img_height=100, img_width=50)
+        self.assertTrue(torch.equal(clipped.boxes, expected))
+
+    def test_cat(self):
+        boxlists = [
+            BoxList(
+                torch.rand((n, 4)),
+                class_ids=torch.randint(0, 3, (n, )),
+                scores=torch.rand((n, ))) for n in [2, 0, 3]
+        ]
+        boxlist = BoxList.cat(boxlists)
+        self.assertEqual(len(boxlist), 5)
+        self.assertTrue(
+            torch.equal(boxlist.boxes,
+                        torch.cat([bl.boxes for bl in boxlists])))
+        for k in ['class_ids', 'scores']:
+            self.assertTrue(
+                torch.equal(
+                    boxlist.get_field(k),
+                    torch.cat([bl.get_field(k) for bl in boxlists])))
+
+    def test_cat_invalid(self):
+        self.assertRaises(ValueError, lambda: BoxList.cat([]))
+        boxlists = [
+            BoxList(torch.rand((2, 4)), class_ids=torch.randint(0, 3, (2, ))),
+            BoxList(
+                torch.rand((2, 4)),
+                class_ids=torch.randint(0, 3, (2, )),
+                scores=torch.rand((2, )))
+        ]
+        self.assertRaises(ValueError, lambda: BoxList.cat(boxlists))
+
+    def test_score_filter(self):
+        boxes = torch.rand((100, 4))
+        scores = torch.rand((100, ))
+        # NaN scores never pass the filter
+        scores[:5] = float('nan')
+        boxlist = BoxList(boxes, scores=scores)
+        for thresh in [0., 0.25, 0.5, 1.]:
+            mask = scores > thresh
+            filtered = boxlist.score_filter(thresh)
+            self.assertTrue(torch.equal(filtered.boxes, boxes[mask]))
+            self.assertTrue(
+                torch.equal(filtered.get_field('scores'), scores[mask]))
+            self.assertFalse(filtered.get_field('scores').isnan().any())
+
+    def _make_nms_boxlists(self) -> List[BoxList]:
+        xy = torch.rand((100, 2)) * 100
+        wh = torch.rand((100, 2)) * 30 + 1
+        boxes = torch.cat([xy, xy + wh], dim=1)
+        class_ids = torch.randint(0, 3, (100, ))
+        scores = torch.rand((100, ))
+        boxlist = BoxList(boxes, class_ids=class_ids, scores=scores)
+        # zero-area boxes, e.g. from clipping at a tile edge
+        degenerate_boxes = torch.tensor([[10., 10., 10., 10.],
+                                         [10., 10., 10., 10.],
+                                         [20., 20., 20., 30.],
+                                         [20., 20., 20., 30.],
+                                         [20., 20., 40., 40.]])
+        degenerate_boxlist = BoxList(
+            degenerate_boxes,
+            class_ids=torch.zeros(5).long(),
+            scores=torch.tensor([0.9, 0.8, 0.7, 0.6, 0.5]))
+        return [boxlist, degenerate_boxlist]
+
+    def test_batched_nms_numba(self):
+        # _nms_kernel is plain Python if numba is not installed
+        for boxlist in self._make_nms_boxlists():
+            args = (boxlist.boxes, boxlist.get_field('scores'),
+                    boxlist.get_field('class_ids'), 0.5)
+            self.assertTrue(
+                torch.equal(_batched_nms_numba(*args), batched_nms(*args)))
+
+    def test_nms(self):
+        for boxlist in self._make_nms_boxlists():
+            expected_inds = batched_nms(boxlist.boxes,
+                                        boxlist.get_field('scores'),
+                                        boxlist.get_field('class_ids'), 0.5)
+            expected = boxlist.ind_filter(expected_inds)
+            self.assertTrue(boxlist.nms(0.5).equal(expected))
+
     def test_collate_fn(self):
         imgs = [torch.empty(3, 100, 100) for _ in range(4)]
         boxlists = []
@@ -148,9 +321,10 @@ class TestBoxList(unittest.TestCase):
             class_ids = torch.randint(0, 3, (10, ))
             boxlist = BoxList(boxes, class_ids=class_ids)
             boxlists.append(boxlist)
-        x, y = collate_fn(zip(imgs, boxes))
+        x, y = collate_fn(zip(imgs, boxlists))
 
         self.assertEqual(x.shape, (4, 3, 100, 100))
+        self.assertEqual(len(y), 4)
         self.assertTrue(all(b1 == b2 for b1, b2 in zip(boxlists, y)))
 
 